@@ -1,10 +1,13 @@
 import geopandas as gpd
 import pandas as pd
 import plotly.express as px
+import hashlib
 import json
 import os
-from dash import Dash, dcc, html, Input, Output, callback
-from dash.dependencies import State
+import re
+import functools
+from shapely.geometry import mapping, shape
+from dash import Dash, dcc, html, Input, Output, Patch, callback
 import webbrowser
 from threading import Timer
 import numpy as np
@@ -13,74 +16,27 @@ import numpy as np
 # --- File Paths ---
 shapefile_path = "./Deploy/ADA_shapefile/lada000b21a_e.shp"  # Canada ADA shapefile
 simplified_shapefile_path = "./Deploy/ADA_shapefile/simplified_ada.shp"  # Simplified shapefile path
+presimplified_features_path = "./Deploy/ADA_shapefile/ada_presimplified.geojsonl"  # Built by build_geometry.py
 csv_path = "./Deploy/BD_dataset.csv"           # Immigration dataset
+cache_dir = "./Deploy/cache"                    # Parquet cache of the prepared data
 
 # --- Core Data Columns ---
 shapefile_id_column = "ADAUID"
 csv_id_column = "ADAUID"
-
-print("=== Starting Canadian Immigration Map Visualization ===")
-
-# === Load and Prepare Data (Only Done Once) ===
-print(f"Reading shapefile: {simplified_shapefile_path}")
-try:
-    # Read shapefile with a more aggressive simplification to improve performance
-    gdf = gpd.read_file(simplified_shapefile_path)
-    gdf[shapefile_id_column] = gdf[shapefile_id_column].astype(str)
-    print(f"Shapefile loaded successfully. Found {len(gdf)} regions.")
-    print(f"Shapefile CRS: {gdf.crs}")
-    
-    # Convert CRS early to improve performance
-    if gdf.crs is not None and gdf.crs != "EPSG:4326":
-        print("Converting CRS to WGS84 (EPSG:4326)...")
-        gdf = gdf.to_crs("EPSG:4326")
-    
-except Exception as e:
-    print(f"Error loading shapefile: {e}")
-    exit()
-
-print(f"Reading CSV data: {csv_path}")
-try:
-    df_csv = pd.read_csv(csv_path)
-    df_csv[csv_id_column] = df_csv[csv_id_column].astype(str)
-    print(f"CSV data loaded successfully. Found {len(df_csv)} rows.")
-except Exception as e:
-    print(f"Error loading CSV file: {e}")
-    exit()
-
-# === Merge Shapefile Geometry with CSV Data ===
-print(f"Merging geometry with data...")
-gdf_merged = gdf.merge(df_csv, left_on=shapefile_id_column, right_on=csv_id_column, how="inner")
-print(f"Rows after merge: {len(gdf_merged)}")
-del gdf  # Free up memory by deleting the original GeoDataFrame
-
-if len(gdf_merged) == 0:
-    print("Error: Merge resulted in zero matching regions. Check if IDs match.")
-    exit()
-
-# === Prepare All Numeric Columns ===
-print("Converting data columns to numeric...")
-# Convert all T columns to numeric in one go
-t_cols = [col for col in gdf_merged.columns if col.startswith('T') or col.startswith('Transit') or col.startswith('Walking')]
-for col in t_cols:
-    gdf_merged[col] = pd.to_numeric(gdf_merged[col], errors='coerce')
-
-# === Create GeoJSON with Reduced Complexity ===
-print("Preparing GeoJSON for Plotly...")
-# Create a simplified copy for GeoJSON generation to improve performance
-gdf_for_json = gdf_merged.copy()
-# Further simplify for JSON creation if needed
-gdf_for_json.geometry = gdf_for_json.geometry.simplify(0.002)  # Even more aggressive for the JSON
-# Set the index to the shapefile ID column for GeoJSON generation
-gdf_for_json = gdf_for_json.set_index(shapefile_id_column)
-geojson_data = json.loads(gdf_for_json.to_json())
-print(f"GeoJSON created with {len(geojson_data.get('features', []))} features.")
-
-
-# Prepare the main dataframe without geometry to reduce memory usage
-df_data = gdf_merged[[shapefile_id_column, 'PRNAME', 'CSDNAME', 'Average Score', 'Average Quintile', 'Population Weighted Score', 'ESAI-Norm', 'IDI_ADA', 'RII_ADA'] + t_cols].copy()
-del gdf_merged  # Free up memory by deleting the merged GeoDataFrame
-
+# Census count columns (T1529...) and the accessibility columns
+data_column_pattern = re.compile(r'^(T\d+|Transit|Walking)')
+# Score columns converted alongside the T columns, and everything else kept in df_data
+score_cols = ['Average Score', 'Population Weighted Score', 'ESAI-Norm', 'IDI_ADA', 'RII_ADA']
+base_data_cols = [shapefile_id_column, 'PRNAME', 'CSDNAME', 'Average Score', 'Average Quintile', 'Population Weighted Score', 'ESAI-Norm', 'IDI_ADA', 'RII_ADA']
+# Down-cast to float32 to halve the bytes touched by every mask, quantile and sum.
+# Counts stay exact well past anything in the census and NaN still marks missing data
+numeric_dtype = 'float32'
+# Province and subdivision names repeat heavily, so store them as small integer codes
+category_cols = ['PRNAME', 'CSDNAME']
+
+# --- Data Cache ---
+# Bump when the code that shapes df_data changes in a way the settings above don't capture
+CACHE_VERSION = 1
 
 # === Define Immigration Data Columns ===
 # Create dictionary of time periods
@@ -149,6 +105,16 @@ origin_countries = {
     'Syria': 'T1590'
 }
 
+# Define the order and labels for the time trend chart
+# Combine the last two periods using T1534
+trend_periods = {
+    'Before 1980': 'T1530',
+    '1980-1990': 'T1531', 
+    '1991-2000': 'T1532',
+    '2001-2010': 'T1533',
+    '2011-2021': 'T1534'  # Combined period using the existing T1534 column
+}
+
 accessibility_modes = {
     'Public Transit': 'Transit_Accessibility',
     'Walking': "Walking_Accessibility"
@@ -163,6 +129,323 @@ other_indicators = {
     'Recent Immigration Intensity': 'RII_ADA',
 }
 
+quantile_options = {
+    'Top 1%': 0.99,
+    'Top 5%': 0.95,
+    'Top 10%': 0.90,
+    'Top 25%': 0.75,
+    'All': 0.0
+}
+
+# Only the columns reachable from the dropdowns and stats panel are kept; the CSV
+# carries many more T columns that would otherwise ride along in df_data
+used_cols = set(time_periods.values()) | set(origin_regions.values()) | set(origin_countries.values()) \
+    | set(trend_periods.values()) | set(accessibility_modes.values())
+
+# Short digest of the input files' contents (plus any extra settings that shape the
+# output), used to name cache files so a stale cache is never read
+def inputs_digest(*paths, extra=()):
+    digest = hashlib.sha1()
+    for path in paths:
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), b''):
+                digest.update(chunk)
+    digest.update(repr(list(extra)).encode())
+    return digest.hexdigest()[:16]
+
+print("=== Starting Canadian Immigration Map Visualization ===")
+
+# === Load and Prepare Data (Only Done Once) ===
+# Prefer the features already simplified offline by build_geometry.py so startup
+# skips both the simplify pass and the GeoJSON build; fall back to the shapefile
+# when they haven't been built
+geometry_presimplified = os.path.exists(presimplified_features_path)
+if geometry_presimplified:
+    print(f"Reading pre-built GeoJSON features: {presimplified_features_path}")
+    try:
+        # One feature per line, already in the shape Plotly expects (id, bbox, geometry)
+        with open(presimplified_features_path) as features_file:
+            prebuilt_features = [json.loads(line) for line in features_file if line.strip()]
+        gdf = pd.DataFrame({shapefile_id_column: [str(feature['id']) for feature in prebuilt_features]})
+        print(f"Features loaded successfully. Found {len(gdf)} regions.")
+    except Exception as e:
+        print(f"Error loading GeoJSON features: {e}")
+        exit()
+else:
+    print(f"Reading shapefile: {simplified_shapefile_path}")
+    try:
+        # Read shapefile with a more aggressive simplification to improve performance
+        # pyogrio decodes columnar through Arrow; the CSV carries every attribute, so only
+        # the ID and geometry are read from the file
+        gdf = gpd.read_file(simplified_shapefile_path, engine="pyogrio", use_arrow=True, columns=[shapefile_id_column])
+        gdf[shapefile_id_column] = gdf[shapefile_id_column].astype(str)
+        print(f"Shapefile loaded successfully. Found {len(gdf)} regions.")
+        print(f"Shapefile CRS: {gdf.crs}")
+        
+        # Convert CRS early to improve performance
+        if gdf.crs is not None and gdf.crs != "EPSG:4326":
+            print("Converting CRS to WGS84 (EPSG:4326)...")
+            gdf = gdf.to_crs("EPSG:4326")
+        
+    except Exception as e:
+        print(f"Error loading shapefile: {e}")
+        exit()
+
+# === Merge Shapefile Geometry with CSV Data ===
+# The merged, converted table only depends on the input files and the settings that
+# shape it, so it is written to Parquet once and read back on later boots. The cache
+# file name carries a digest of all of those so it is rebuilt whenever one changes.
+# Only the region IDs come from the geometry side: the pre-built features are already
+# parsed, so their ids are hashed directly, and the shapefile keeps its IDs in the .dbf
+data_cache_settings = [
+    CACHE_VERSION, sorted(used_cols), data_column_pattern.pattern, score_cols,
+    base_data_cols, numeric_dtype, category_cols
+]
+if geometry_presimplified:
+    geometry_source_files = []
+    data_cache_settings.append(gdf[shapefile_id_column].tolist())
+else:
+    geometry_source_files = [os.path.splitext(simplified_shapefile_path)[0] + ".dbf"]
+try:
+    data_cache_path = os.path.join(cache_dir, f"df_data_{inputs_digest(csv_path, *geometry_source_files, extra=data_cache_settings)}.parquet")
+except Exception as e:
+    # The digest reads the CSV and, without pre-built features, the shapefile's .dbf
+    print(f"Error reading input files for the data cache: {e}")
+    exit()
+df_data = None
+if os.path.exists(data_cache_path):
+    print(f"Reading cached data: {data_cache_path}")
+    try:
+        df_data = pd.read_parquet(data_cache_path)
+        print(f"Cached data loaded successfully. Found {len(df_data)} rows.")
+    except Exception as e:
+        # A damaged cache is rebuilt from the CSV like a missing one
+        print(f"Could not read data cache, rebuilding it: {e}")
+        try:
+            os.remove(data_cache_path)
+        except OSError:
+            pass
+if df_data is None:
+    print(f"Reading CSV data: {csv_path}")
+    try:
+        df_csv = pd.read_csv(csv_path)
+        df_csv[csv_id_column] = df_csv[csv_id_column].astype(str)
+        print(f"CSV data loaded successfully. Found {len(df_csv)} rows.")
+    except Exception as e:
+        print(f"Error loading CSV file: {e}")
+        exit()
+
+    print(f"Merging geometry with data...")
+    # Only the IDs are needed from the geometry side; the GeoJSON is built from gdf below
+    gdf_merged = gdf[[shapefile_id_column]].merge(df_csv, left_on=shapefile_id_column, right_on=csv_id_column, how="inner")
+    print(f"Rows after merge: {len(gdf_merged)}")
+    del df_csv
+
+    if len(gdf_merged) == 0:
+        print("Error: Merge resulted in zero matching regions. Check if IDs match.")
+        exit()
+
+    # === Prepare All Numeric Columns ===
+    print("Converting data columns to numeric...")
+    # Convert all T columns to numeric in one go
+    t_cols = [col for col in gdf_merged.columns if col in used_cols and data_column_pattern.match(col)]
+    numeric_cols = t_cols + score_cols
+    gdf_merged[numeric_cols] = gdf_merged[numeric_cols].apply(pd.to_numeric, errors='coerce').astype(numeric_dtype)
+
+    # Prepare the main dataframe without geometry to reduce memory usage
+    df_data = gdf_merged[base_data_cols + t_cols].copy()
+    del gdf_merged  # Free up memory by deleting the merged GeoDataFrame
+    for col in category_cols:
+        df_data[col] = df_data[col].astype('category')
+
+    print(f"Writing data cache: {data_cache_path}")
+    # Write next to the final path and rename it into place, so an interrupted write
+    # or another worker booting at the same time never leaves a truncated cache behind
+    data_cache_tmp_path = f"{data_cache_path}.{os.getpid()}.tmp"
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+        df_data.to_parquet(data_cache_tmp_path, compression='zstd', index=False)
+        os.replace(data_cache_tmp_path, data_cache_path)
+    except Exception as e:
+        # The cache only saves time on the next boot, so carry on without it
+        print(f"Could not write data cache: {e}")
+        try:
+            os.remove(data_cache_tmp_path)
+        except OSError:
+            pass
+
+    # Caches for older inputs can never be hit again, so drop them
+    for cache_file in os.listdir(cache_dir) if os.path.isdir(cache_dir) else []:
+        if cache_file.startswith("df_data_") and cache_file.endswith(".parquet") \
+                and cache_file != os.path.basename(data_cache_path):
+            try:
+                os.remove(os.path.join(cache_dir, cache_file))
+            except OSError as e:
+                print(f"Could not remove old data cache {cache_file}: {e}")
+
+# === Create GeoJSON with Reduced Complexity ===
+print("Preparing GeoJSON for Plotly...")
+# Keep only the regions that matched a CSV row
+merged_ids = set(df_data[shapefile_id_column])
+if geometry_presimplified:
+    features = [feature for feature in prebuilt_features if str(feature['id']) in merged_ids]
+    del prebuilt_features
+    # build_geometry.py asks GDAL for a bbox per feature, but fall back to the
+    # geometry's own bounds for files written without one. Plotly never reads the
+    # bbox, so it is popped off to keep it out of the figure sent to the browser
+    bboxes = [feature.pop('bbox', None) for feature in features]
+    bboxes = np.array([
+        bbox if bbox is not None else shape(feature['geometry']).bounds
+        for bbox, feature in zip(bboxes, features) if feature.get('geometry')
+    ])
+    if len(bboxes) == 0:
+        print("Error: No pre-built features with geometry matched the CSV data.")
+        exit()
+    min_lon, min_lat = bboxes[:, 0].min(), bboxes[:, 1].min()
+    max_lon, max_lat = bboxes[:, 2].max(), bboxes[:, 3].max()
+else:
+    # Create a simplified copy for GeoJSON generation to improve performance
+    gdf_for_json = gdf[gdf[shapefile_id_column].isin(merged_ids)].copy()
+    # Further simplify for JSON creation if needed
+    gdf_for_json.geometry = gdf_for_json.geometry.simplify(0.002)  # Even more aggressive for the JSON
+    # Build the feature dicts directly instead of round-tripping through a JSON
+    # string; Plotly only needs the id and geometry of each feature
+    features = [
+        {'type': 'Feature', 'id': region_id, 'properties': {}, 'geometry': mapping(geom) if geom is not None else None}
+        for region_id, geom in zip(gdf_for_json[shapefile_id_column], gdf_for_json.geometry)
+    ]
+    min_lon, min_lat, max_lon, max_lat = gdf_for_json.total_bounds
+    del gdf_for_json
+del gdf  # Free up memory by deleting the original GeoDataFrame
+geojson_data = {'type': 'FeatureCollection', 'features': features}
+print(f"GeoJSON created with {len(geojson_data.get('features', []))} features.")
+# Centre of the ADA extent, used to frame the tile map since it has no fitbounds
+map_center = {'lat': float((min_lat + max_lat) / 2), 'lon': float((min_lon + max_lon) / 2)}
+
+
+# Quantile of a descending-sorted array using numpy's default linear interpolation.
+# The data is already sorted, so this is an O(1) index lookup instead of the
+# partition np.quantile would run on every call.
+def sorted_quantile(desc_values, q):
+    position = q * (len(desc_values) - 1)
+    lower = int(np.floor(position))
+    upper = min(lower + 1, len(desc_values) - 1)
+    # Index i of the ascending order is index n-1-i of the descending one
+    low_value = desc_values[len(desc_values) - 1 - lower]
+    high_value = desc_values[len(desc_values) - 1 - upper]
+    return low_value + (high_value - low_value) * (position - lower)
+
+# Length of the prefix kept by a quantile filter and the colour scale cap for it.
+# Values are sorted descending, so everything >= threshold is a prefix of the view;
+# searching the reversed view counts that prefix without allocating a negated copy
+def quantile_cut(desc_values, q):
+    threshold = sorted_quantile(desc_values, q)
+    cutoff_idx = len(desc_values) - np.searchsorted(desc_values[::-1], threshold, side='left')
+    if cutoff_idx == 0:
+        return 0, 0
+    max_value = sorted_quantile(desc_values[:cutoff_idx], 0.99)
+    if max_value <= 0:
+        max_value = desc_values[0]
+    return cutoff_idx, max_value
+
+# === Precompute Per-Column Sorted Views (Only Done Once) ===
+print("Precomputing sorted views for selectable columns...")
+candidate_cols = set(time_periods.values()) | set(origin_regions.values()) | set(origin_countries.values()) \
+    | set(accessibility_modes.values()) | set(other_indicators.values()) | set(title_column_selector.values())
+# Plain numpy arrays for everything the map callback reads, so the hot path indexes
+# contiguous arrays instead of going through pandas
+VALS = {col: df_data[col].to_numpy() for col in candidate_cols if col in df_data.columns}
+IDS = df_data[shapefile_id_column].to_numpy()
+
+# Split a categorical column into its integer codes and a label lookup, so names are
+# only materialised for the rows actually plotted. Missing values have code -1, which
+# indexes the trailing None.
+def category_lookup(series):
+    return series.cat.codes.to_numpy(), np.append(series.cat.categories.to_numpy(dtype=object), None)
+
+PRNAME_CODES, PRNAME_LABELS = category_lookup(df_data['PRNAME'])
+CSDNAME_CODES, CSDNAME_LABELS = category_lookup(df_data['CSDNAME'])
+
+# Every dropdown combination resolves to one of these columns, so sort each once
+# here and let the callback cut the top quantile off the front of the view.
+# Each entry holds the row positions of the non-NaN values in descending order
+# and the values in that same order.
+# The NaN mask is only needed while sorting, so it is not kept; columns with no
+# missing values skip the masking entirely
+COL_CACHE = {}
+for col, values in VALS.items():
+    mask = ~np.isnan(values)
+    valid_idx = np.arange(len(values)) if mask.all() else np.flatnonzero(mask)
+    order = valid_idx[np.argsort(-values[valid_idx], kind='stable')]
+    COL_CACHE[col] = (order, values[order])
+print(f"Cached sorted views for {len(COL_CACHE)} columns.")
+
+# The quantile dropdown only offers a handful of values, so the cut and colour cap
+# for every column/quantile pair are looked up instead of computed per callback
+QUANTILE_CUTS = {
+    (col, q): quantile_cut(vals, q)
+    for col, (order, vals) in COL_CACHE.items() if len(vals)
+    for q in quantile_options.values()
+}
+
+# Origin-country counts as one (regions x countries) matrix for the pie chart, with a
+# lookup from ADAUID to matrix row (also the df_data row used by the stats panel)
+COUNTRY_LABELS = np.array(list(origin_countries.keys()))
+COUNTRY_MAT = df_data[list(origin_countries.values())].to_numpy(dtype=np.float32)
+REGION_IDX = {region_id: i for i, region_id in enumerate(IDS)}
+
+# === Base Map Figure (Sent Once) ===
+# Customize hover template
+hovertemplate = """
+<b>%{customdata[1]}, %{customdata[0]}</b><br>
+<b>ADAUID:</b> %{customdata[2]}<br>
+<b>Immigrants:</b> %{customdata[3]:,.0f}<br> 
+<b>Percentage of immigrants:</b> %{customdata[4]:.2%}<br> 
+<b>CIMD Quintile:</b> %{customdata[5]:.1f}<br>
+<b>CIMD Score:</b> %{customdata[6]:.1f}<br>
+<extra></extra>
+"""
+
+# Render on a WebGL tile map instead of the SVG geo projection for faster redraws.
+# The full figure, including every polygon, ships once with the page; the map callback
+# only patches the per-selection fields on top of it. It is a plain dict that Dash
+# serialises directly, skipping the validation of plotly's graph objects, and the
+# fixed uirevision keeps the user's pan and zoom across updates.
+base_map_figure = {
+    'data': [{
+        'type': 'choroplethmap',
+        'geojson': geojson_data,
+        'locations': [],
+        'featureidkey': 'id',
+        'z': [],
+        'colorscale': 'Viridis',
+        'zmin': 0,
+        'colorbar': {
+            'title': {'text': '', 'font': {'color': 'white'}},
+            'lenmode': 'fraction',
+            'len': 0.75,
+            'thickness': 20,
+            'xanchor': 'right',
+            'x': 1.02,
+            'tickfont': {'color': 'white'}
+        },
+        'hovertemplate': hovertemplate,
+        'marker': {'line': {'width': 0}, 'opacity': 1}
+    }],
+    'layout': {
+        'map': {
+            'style': 'carto-darkmatter',  # Dark basemap, no access token needed
+            'center': map_center,
+            'zoom': 3
+        },
+        'paper_bgcolor': 'black',     # Background outside the map
+        'plot_bgcolor': 'black',      # Background inside the plot area
+        'font': {'color': 'white'},
+        'margin': {'r': 0, 't': 40, 'l': 0, 'b': 0},
+        'uirevision': 'immigration-map'
+    }
+}
+
 # === Create Dash App ===
 print("\nSetting up Dash application...")
 app = Dash(__name__)
@@ -284,13 +567,7 @@ app.layout = html.Div([
             html.Label("Filter by Quantile:", style={'fontWeight': 'bold'}),
             dcc.Dropdown(
                 id='quantile-dropdown',
-                options=[
-                    {'label': 'Top 1%', 'value': 0.99},
-                    {'label': 'Top 5%', 'value': 0.95},
-                    {'label': 'Top 10%', 'value': 0.90},
-                    {'label': 'Top 25%', 'value': 0.75},
-                    {'label': 'All', 'value': 0.0}
-                ],
+                options=[{'label': label, 'value': q} for label, q in quantile_options.items()],
                 value=0.0,
                 clearable=False
             ),
@@ -340,7 +617,7 @@ app.layout = html.Div([
                 id="loading-map",
                 type="circle",
                 children=[
-                    dcc.Graph(id='immigration-map', style={'height': '75vh'})
+                    dcc.Graph(id='immigration-map', figure=base_map_figure, style={'height': '75vh'})
                 ]
             )
         ], style={'width': '75%', 'display': 'inline-block', 'verticalAlign': 'top'}),
@@ -364,16 +641,64 @@ app.layout = html.Div([
     html.Div([
         html.P("Data Source: Statistics Canada 2021 Census - Bridging Divides Migration Data Challenge", 
             style={'textAlign': 'center', 'fontStyle': 'italic', 'marginTop': '20px'})
-    ]),
-    
-    # Add a store component to cache data and prevent re-renders
-    dcc.Store(id='cached-data', storage_type='memory')
+    ])
 ])
 
+# Compute the per-selection trace fields for one resolved column and quantile. Every
+# dropdown combination collapses to a single data column, so revisiting a previous
+# selection is served from the cache instead of being rebuilt.
+@functools.lru_cache(maxsize=128)
+def build_map_selection(data_column, selected_quantile):
+    if data_column not in COL_CACHE:
+        return None
+
+    order, vals = COL_CACHE[data_column]
+    if len(vals) == 0:
+        return None
+    cut = QUANTILE_CUTS.get((data_column, selected_quantile))
+    cutoff_idx, max_value = cut if cut is not None else quantile_cut(vals, selected_quantile)
+    plot_idx = order[:cutoff_idx]
+    plot_values = vals[:cutoff_idx]
+
+    if len(plot_idx) == 0:
+        return None
+    
+    # Prepare additional data for hover information
+    # Calculate percentage of total for each region, reusing one output buffer for
+    # the divide, round and scale instead of allocating a temporary per step
+    total_immigrants = plot_values.sum(dtype=np.float64)
+    percent_of_total = np.zeros(len(plot_values))
+    if total_immigrants > 0:
+        np.divide(plot_values, total_immigrants, out=percent_of_total)
+        np.round(percent_of_total, 4, out=percent_of_total)
+        percent_of_total *= 100  # Store as proportion
+
+    return {
+        'locations': IDS[plot_idx],
+        'z': plot_values,
+        'zmax': float(max_value),
+        'customdata': np.column_stack([
+            PRNAME_LABELS[PRNAME_CODES[plot_idx]], CSDNAME_LABELS[CSDNAME_CODES[plot_idx]], IDS[plot_idx], VALS['T1529'][plot_idx],
+            percent_of_total, VALS['Average Quintile'][plot_idx], VALS['Average Score'][plot_idx]
+        ])
+    }
+
+# Patch that empties the choropleth and shows a message in the title, leaving the
+# base figure's GeoJSON in place for the next selection
+def clear_map_patch(title):
+    map_patch = Patch()
+    map_patch['data'][0]['locations'] = []
+    map_patch['data'][0]['z'] = []
+    map_patch['data'][0]['customdata'] = []
+    # Reset the colour bar as well so it doesn't keep the previous column's name and range
+    map_patch['data'][0]['zmax'] = None
+    map_patch['data'][0]['colorbar']['title']['text'] = ''
+    map_patch['layout']['title'] = {'text': title}
+    return map_patch
+
 # Define callback for updating map and statistics based on dropdown selections
 @app.callback(
-    [Output('immigration-map', 'figure'),
-     Output('cached-data', 'data')],
+    Output('immigration-map', 'figure'),
     [Input('period-dropdown', 'value'),
      Input('region-dropdown', 'value'),
      Input('country-dropdown', 'value'),
@@ -404,104 +729,36 @@ def update_map_and_stats(selected_period, selected_region, selected_country, sel
             data_column = selected_period
         map_title = f"Immigration by {data_column}"
 
-    full_data = df_data[df_data[data_column].notna()].copy()
-    threshold = full_data[data_column].quantile(selected_quantile)
-    df_plot = full_data[full_data[data_column] >= threshold]
-
-    if len(df_plot) == 0:
-        return px.choropleth(title="No Data Available"), None
-
-    max_value = df_plot[data_column].quantile(0.99)
-    if max_value <= 0:
-        max_value = df_plot[data_column].max()
-    
-    # Prepare additional data for hover information
-    # Calculate percentage of total for each region
-    total_immigrants = df_plot[data_column].sum()
-    if total_immigrants > 0:
-        df_plot['percent_of_total'] = (df_plot[data_column] / total_immigrants).round(4)*100  # Store as proportion
-    else:
-        df_plot['percent_of_total'] = 0
-        
-    # Create the choropleth map
     try:
-        # Use a simplified mapbox approach for faster rendering
-        fig = px.choropleth(
-            df_plot,
-            geojson=geojson_data,
-            locations=shapefile_id_column,
-            featureidkey="id",
-            color=data_column,
-            color_continuous_scale="Viridis",
-            range_color=(0, max_value),
-            custom_data=['PRNAME', 'CSDNAME', 'ADAUID', 'T1529', 'percent_of_total', 'Average Quintile', 'Average Score']
-        )
-        
-        # Customize hover template
-        hovertemplate = """
-        <b>%{customdata[1]}, %{customdata[0]}</b><br>
-        <b>ADAUID:</b> %{customdata[2]}<br>
-        <b>Immigrants:</b> %{customdata[3]:,.0f}<br> 
-        <b>Percentage of immigrants:</b> %{customdata[4]:.2%}<br> 
-        <b>CIMD Quintile:</b> %{customdata[5]:.1f}<br>
-        <b>CIMD Score:</b> %{customdata[6]:.1f}<br>
-        <extra></extra>
-        """
-        
-        # Apply the hover template
-        fig.update_traces(hovertemplate=hovertemplate, marker_line_width=0, marker_opacity=1)
-        
-        # Add title
-        fig.update_layout(title=map_title)
-        
-        # Simplified map settings for better performance
-        fig.update_geos(
-            fitbounds="locations",
-            visible=True,
-            showcoastlines=True,
-            coastlinecolor="gray",
-            showland=True,
-            landcolor="black",         # Dark land
-            showlakes=True,
-            lakecolor="black",         # Match background
-            showrivers=False,
-            bgcolor="black"            # Entire map background
-        )
-
-        
-        fig.update_layout(
-            paper_bgcolor="black",     # Background outside the map
-            plot_bgcolor="black",      # Background inside the plot area
-            font=dict(color="white"),
-            margin={"r": 0, "t": 40, "l": 0, "b": 0},
-            coloraxis_colorbar=dict(
-                title=dict(text=data_column, font=dict(color="white")),
-                lenmode="fraction",
-                len=0.75,
-                thickness=20,
-                xanchor="right",
-                x=1.02,
-                tickfont=dict(color="white")
-            )
-        )
+        selection = build_map_selection(data_column, selected_quantile)
     except Exception as e:
         print(f"Error creating map: {e}")
-        return px.choropleth(title=f"Error: {str(e)}"), None
+        return clear_map_patch(f"Error: {str(e)}")
+
+    if selection is None:
+        return clear_map_patch("No Data Available")
 
-    return fig, df_plot.to_dict('records')
+    # Only the fields that depend on the selection are sent; the polygons already in
+    # the browser are reused
+    map_patch = Patch()
+    for key, value in selection.items():
+        map_patch['data'][0][key] = value
+    map_patch['data'][0]['colorbar']['title']['text'] = data_column
+    map_patch['layout']['title'] = {'text': map_title}
+
+    return map_patch
 
 # Change callback to trigger on clickData for the stats-panel
 @app.callback(
     Output('stats-panel', 'children'),
-    [Input('immigration-map', 'clickData')], # Changed from hoverData to clickData
-    [State('cached-data', 'data')]
+    [Input('immigration-map', 'clickData')] # Changed from hoverData to clickData
 )
-def update_stats_on_click(click_data, cached_data_list): # Renamed function and first argument
+def update_stats_on_click(click_data): # Renamed function and first argument
     import time
     start_time = time.time()
     
     # If no click data is available, return message to click
-    if not click_data or not cached_data_list:
+    if not click_data:
         return html.Div("Click on a region to see details.") # Updated message
     
     # Get the clicked region data
@@ -525,39 +782,31 @@ def update_stats_on_click(click_data, cached_data_list): # Renamed function and
 
     # Pie chart logic
     region_id = point['location']
-    hovered_region_data = None # Variable name can remain, context is now 'clicked'
-    for region_data_dict in cached_data_list:
-        if region_data_dict[shapefile_id_column] == region_id:
-            hovered_region_data = region_data_dict
-            break
+    # Look the region up server-side rather than round-tripping rows through the browser
+    region_row = REGION_IDX.get(region_id)
+    hovered_region_data = df_data.iloc[region_row] if region_row is not None else None # Variable name can remain, context is now 'clicked'
     
     pie_chart_children = []
-    if hovered_region_data:
-        origin_pie_data = {}
-        # Using origin_countries to get column names and labels for specific countries
-        for label, col_name in origin_countries.items(): 
-            origin_pie_data[label] = hovered_region_data.get(col_name, 0)
+    if hovered_region_data is not None:
+        # Row of origin-country counts for this region; missing and negative values count as zero
+        origin_values = COUNTRY_MAT[region_row]
+        origin_values = np.where(origin_values > 0, origin_values, 0)
         
         # Calculate total for percentage calculation (sum of all specified origin countries)
-        total_origin_sum = sum(value for value in origin_pie_data.values() if pd.notna(value) and value > 0)
+        total_origin_sum = origin_values.sum()
 
         pie_labels = []
         pie_values = []
-        others_sum = 0
 
         if total_origin_sum > 0: # Proceed only if there's any origin data
-            for label, value in origin_pie_data.items():
-                if pd.notna(value) and value > 0:
-                    percentage = (value / total_origin_sum) * 100
-                    if percentage > 2:
-                        pie_labels.append(label)
-                        pie_values.append(value)
-                    else:
-                        others_sum += value
+            keep = origin_values / total_origin_sum * 100 > 2
+            pie_labels = COUNTRY_LABELS[keep].tolist()
+            pie_values = origin_values[keep].tolist()
+            others_sum = origin_values[~keep].sum()
             
             if others_sum > 0:
                 pie_labels.append("Others (<2%)")
-                pie_values.append(others_sum)
+                pie_values.append(float(others_sum))
 
         if sum(pie_values) > 0: # Check if there's anything to plot after filtering
             pie_fig = px.pie(
@@ -579,25 +828,15 @@ def update_stats_on_click(click_data, cached_data_list): # Renamed function and
         else:
             pie_chart_children.append(html.P("No detailed country of origin data available for this region.", style={'marginTop': '10px'})) 
     else:
-        pie_chart_children.append(html.P("Region data not found in cache for pie chart.", style={'marginTop': '10px'}))
+        pie_chart_children.append(html.P("Region data not found for pie chart.", style={'marginTop': '10px'}))
 
     # Time trend bar chart logic
     time_trend_chart_children = []
-    if hovered_region_data: # Variable name can remain, context is now 'clicked'
-        # Define the order and labels for the time trend chart
-        # Combine the last two periods using T1534
-        trend_periods_ordered = {
-            'Before 1980': 'T1530',
-            '1980-1990': 'T1531', 
-            '1991-2000': 'T1532',
-            '2001-2010': 'T1533',
-            '2011-2021': 'T1534'  # Combined period using the existing T1534 column
-        }
-        
+    if hovered_region_data is not None: # Variable name can remain, context is now 'clicked'
         trend_labels = []
         trend_values = []
         
-        for label, col_name in trend_periods_ordered.items():
+        for label, col_name in trend_periods.items():
             value = hovered_region_data.get(col_name, 0)
             if pd.notna(value): 
                 trend_labels.append(label)
@@ -627,7 +866,7 @@ def update_stats_on_click(click_data, cached_data_list): # Renamed function and
         else:
             time_trend_chart_children.append(html.P("No time trend data available for this region.", style={'marginTop': '10px'}))
     else:
-        time_trend_chart_children.append(html.P("Region data not found in cache for trend chart.", style={'marginTop': '10px'}))
+        time_trend_chart_children.append(html.P("Region data not found for trend chart.", style={'marginTop': '10px'}))
 
     return html.Div(text_info_children + pie_chart_children + time_trend_chart_children)
 
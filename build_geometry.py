@@ -0,0 +1,55 @@
+import geopandas as gpd
+import numpy as np
+import shapely
+from joblib import Parallel, delayed
+
+# === Configuration ===
+# --- File Paths ---
+simplified_shapefile_path = "./Deploy/ADA_shapefile/simplified_ada.shp"  # Simplified shapefile path
+presimplified_features_path = "./Deploy/ADA_shapefile/ada_presimplified.geojsonl"  # Output read by app.py
+
+# --- Core Data Columns ---
+shapefile_id_column = "ADAUID"
+
+# --- Simplification ---
+# Tolerance in degrees (~200m), the same pass app.py used to run on every startup
+simplify_tolerance = 0.002
+# Decimal places kept per coordinate (~10m), well below the simplification tolerance
+coordinate_precision = 4
+# Number of geometry chunks simplified concurrently (-1 uses every core)
+n_jobs = -1
+
+print("=== Building Pre-Simplified ADA Geometry ===")
+
+# === Load Shapefile ===
+print(f"Reading shapefile: {simplified_shapefile_path}")
+gdf = gpd.read_file(simplified_shapefile_path, engine="pyogrio", use_arrow=True, columns=[shapefile_id_column])
+gdf[shapefile_id_column] = gdf[shapefile_id_column].astype(str)
+print(f"Shapefile loaded successfully. Found {len(gdf)} regions.")
+
+if gdf.crs is not None and gdf.crs != "EPSG:4326":
+    print("Converting CRS to WGS84 (EPSG:4326)...")
+    gdf = gdf.to_crs("EPSG:4326")
+
+# === Simplify Once, Offline ===
+print(f"Simplifying geometry with tolerance {simplify_tolerance}...")
+# GEOS releases the GIL while simplifying, so threads split the polygons across cores
+# without copying geometry into worker processes
+chunks = np.array_split(gdf.geometry.to_numpy(), max(1, min(len(gdf), 64)))
+simplified = Parallel(n_jobs=n_jobs, prefer="threads")(
+    delayed(shapely.simplify)(chunk, simplify_tolerance, preserve_topology=True) for chunk in chunks
+)
+gdf.geometry = gpd.GeoSeries(np.concatenate(simplified), index=gdf.index, crs=gdf.crs)
+
+# Line-delimited GeoJSON is streamed out one feature at a time, so the whole
+# FeatureCollection never has to be held as one string. Each line carries the ADAUID
+# as the feature id and a bbox, which is all app.py needs besides the geometry.
+print(f"Writing pre-simplified features: {presimplified_features_path}")
+gdf.to_file(
+    presimplified_features_path,
+    driver="GeoJSONSeq",
+    COORDINATE_PRECISION=coordinate_precision,
+    ID_FIELD=shapefile_id_column,
+    WRITE_BBOX="YES"
+)
+print("Done.")